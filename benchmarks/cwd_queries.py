@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Carl Anderson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Benchmarks the saved RCWD and CWD queries on a deep directory tree.
+
+A history database is filled with commands run all over a monorepo-like tree,
+in which the benchmarked subtree only holds a small fraction of the history.
+The saved queries (from the queries file in this source tree) are then timed
+the way ash_query runs them, against the LIKE filter used by earlier versions
+of RCWD, with and without the cwd index.
+
+Usage:
+  benchmarks/cwd_queries.py [commands] [depth]
+"""
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT, 'python'))
+
+import _ash_log
+import ash_query
+from advanced_shell_history import util
+
+
+# The RCWD query used by earlier versions, which sqlite cannot use an index for
+# (LIKE is case-insensitive by default).
+LIKE_SQL = '''
+  select
+    c.session_id as "session",
+    c.cwd as "where",
+    datetime(c.start_time, 'unixepoch', 'localtime') as "when",
+    c.command as "what"
+  from
+    commands as c
+  where
+    c.cwd = '%(pwd)s' or c.cwd = '/%(pwd)s'
+    or c.cwd like '%(pwd)s/%%' or c.cwd like '/%(pwd)s/%%'
+  order by c.id
+  ;
+'''
+
+
+def MakeTree(root, depth, fanout=6):
+  """Returns the directories of a tree, with the deepest directories last."""
+  level = [root]
+  tree = list(level)
+  for _ in range(depth):
+    level = ['%s/d%d' % (parent, i) for parent in level for i in range(fanout)]
+    tree.extend(level)
+  return tree
+
+
+def Populate(count, tree):
+  """Inserts count commands spread over the tree into the database.
+
+  The commands table is created by _ash_log, with all its indexes.
+  """
+  with util.Database.Transaction():
+    _ash_log.Command()
+    util.Database.BeginWrite()
+    rows = [(1 + i // 100, 1, i, 'pts/0', 0, random.choice(tree), 0, i, i, 0,
+             'make -j8 target%d' % i) for i in range(count)]
+    util.Database.Connect().executemany(
+        'INSERT INTO commands (session_id, shell_level, command_no, tty, euid, '
+        'cwd, rval, start_time, end_time, duration, command) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def Time(sql, repeat=5):
+  """Returns the best time (in ms) of several runs and the rows found."""
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    rows = ash_query.ResultCache.FetchRange(sql, None, None, None)
+    elapsed = (time.time() - start) * 1000
+    best = elapsed if best is None else min(best, elapsed)
+  return best, rows and len(rows) - 1 or 0
+
+
+def main(argv):
+  count = int(argv[1]) if len(argv) > 1 else 500000
+  depth = int(argv[2]) if len(argv) > 2 else 5
+  random.seed(0)
+  directory = tempfile.mkdtemp(prefix='ash_benchmark.')
+  cwd = os.getcwd()
+  try:
+    tree = MakeTree(os.path.join(directory, 'monorepo'), depth)
+    # A subtree two levels down holds about 1 / fanout^2 of the history.
+    pwd = tree[1 + 6 + 6 * 6 // 2]
+    # Only the saved queries from this source tree are loaded, and they are
+    # run from the benchmarked subtree, so that ${PWD} expands to it.
+    os.environ['ASH_CFG_SYSTEM_QUERY_FILE'] = os.path.join(_ROOT, 'queries')
+    os.environ['HOME'] = directory
+    os.makedirs(pwd)
+    os.chdir(pwd)
+    os.environ['PWD'] = pwd
+    ash_query.Queries.Init()
+    util.Database.filename = os.path.join(directory, 'history.db')
+    Populate(count, tree)
+    queries = [('RCWD (LIKE)', LIKE_SQL % {'pwd': pwd})]
+    queries.extend([(x, ash_query.Queries.Get(x)[1]) for x in ('RCWD', 'CWD')])
+
+    print('%d commands in %d directories, %d levels deep; PWD=%s' % (
+        count, len(tree), depth + 1, pwd))
+    for indexed in (False, True):
+      connection = util.Database.Connect()
+      if indexed:
+        # Checking the schema again recreates the index.
+        util.Database.Close()
+        with util.Database.Transaction():
+          _ash_log.Command()
+        connection = util.Database.Connect()
+        connection.execute('ANALYZE')
+      else:
+        connection.execute('DROP INDEX commands_cwd')
+      print('%s the cwd index:' % (indexed and 'With' or 'Without'))
+      for name, sql in queries:
+        ms, rows = Time(sql)
+        print('  %-14s %9.2f ms %8d rows' % (name, ms, rows))
+  finally:
+    util.Database.Close()
+    os.chdir(cwd)
+    shutil.rmtree(directory)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -27,7 +27,13 @@ __version__ = '0.8r1'
 
 import logging
 import os
+import random
+import re
+import shlex
+import sqlite3
 import sys
+import time
+import zlib
 
 # Allow the local advanced_shell_history library to be imported.
 _LIB = '/usr/local/lib'
@@ -55,6 +61,9 @@ class Flags(util.Flags):
   flags = (
     ('S', 'get_session_id', 'emits the session ID (or creates one)'),
     ('E', 'end_session', 'ends the current session'),
+    ('M', 'maintain', 'optimizes, analyzes and vacuums the database'),
+    ('U', 'upgrade', 'upgrades previously logged history to the current format'),
+    ('F', 'flush_spool', 'logs the commands spooled by the current session'),
   )
 
   def __init__(self):
@@ -62,14 +71,79 @@ class Flags(util.Flags):
 
 
 class Session(util.Database.Object):
-  """An abstraction of a shell session to store to the history database."""
+  """An abstraction of a shell session to store to the history database.
 
-  def __init__(self):
-    """Initialize a Session, populating session values."""
+  Session ids are normally assigned by the database when the session is
+  inserted.  When ASH_CFG_LOCAL_SESSION_IDS is enabled, ids are instead built
+  locally from the session start time and random bits:
+
+    bits 62-32: seconds since LOCAL_ID_EPOCH
+    bits 31-0:  random
+
+  Two sessions only share an id if they start in the same second and draw the
+  same 32 random bits, so ids from many hosts can be merged.  They can be
+  handed to a new shell without waiting for the database.  The sessions row is
+  written lazily, along with the first command logged by the session (or when
+  it ends).
+
+  Database-assigned ids are kept at or below MAX_DATABASE_ID, out of the range
+  of local ids.
+  """
+
+  # 2017-01-01 00:00:00 UTC, which leaves 31 bits of seconds until 2085.
+  LOCAL_ID_EPOCH = 1483228800
+
+  # The largest session id assigned by the database.
+  MAX_DATABASE_ID = 0xffffffff
+
+  def __init__(self, session_id=None):
+    """Initialize a Session, optionally with a locally generated id."""
     util.Database.Object.__init__(self, 'sessions')
-    self.values = {
+    self.session_id = session_id
+
+  @classmethod
+  def NewLocalId(cls):
+    """Returns a new locally generated session id."""
+    seconds = unix.GetTime() - cls.LOCAL_ID_EPOCH
+    return (seconds << 32) | random.SystemRandom().getrandbits(32)
+
+  @classmethod
+  def IsLocalId(cls, session_id):
+    """Returns True if the session id was generated locally."""
+    return session_id > cls.MAX_DATABASE_ID
+
+  @classmethod
+  def NextDatabaseId(cls):
+    """Returns the id to assign to a new session inserted by the database.
+
+    Inserting a local id advances the autoincrement sequence into the range of
+    local ids, so the id is instead chosen explicitly, after the largest
+    database-assigned id.
+    """
+    util.Database.BeginWrite()
+    rs = util.Database.Connect().execute(
+        'SELECT max(id) FROM sessions WHERE id <= ?',
+        (cls.MAX_DATABASE_ID,)).fetchone()
+    return (rs[0] or 0) + 1
+
+  @classmethod
+  def InsertLocal(cls, session_id):
+    """Inserts the sessions row for a local session id, if not already done."""
+    # Creating the Session first ensures that the sessions table exists.
+    session = Session(session_id)
+    sql = 'SELECT 1 FROM sessions WHERE id = ?;'
+    if not util.Database().Fetch(sql, (session_id,)):
+      session.Insert()
+
+  def GetValues(self):
+    """Returns the session values, gathered only when they are inserted."""
+    if self.session_id:
+      start_time = (self.session_id >> 32) + Session.LOCAL_ID_EPOCH
+    else:
+      start_time = unix.GetTime()
+    values = {
       'time_zone': unix.GetTimeZone(),
-      'start_time': unix.GetTime(),
+      'start_time': start_time,
       'ppid': unix.GetPPID(),
       'pid': unix.GetPID(),
       'tty': unix.GetTTY(),
@@ -84,6 +158,8 @@ class Session(util.Database.Object):
       'ssh_client': unix.GetEnv('SSH_CLIENT'),
       'ssh_connection': unix.GetEnv('SSH_CONNECTION')
     }
+    values['id'] = self.session_id or Session.NextDatabaseId()
+    return values
 
   def GetCreateTableSql(self):
     return '''
@@ -108,8 +184,17 @@ CREATE TABLE sessions (
   ssh_connection varchar(100) 
 )'''
 
-  def Close(self):
-    """Closes this session in the database."""
+  @classmethod
+  def Close(cls):
+    """Closes the current session in the database.
+
+    This only updates the existing sessions row, so none of the session
+    metadata needs to be gathered (unless a locally generated session ended
+    before logging any commands).
+    """
+    session_id = unix.GetEnvInt('ASH_SESSION_ID')
+    if Session.IsLocalId(session_id):
+      Session.InsertLocal(session_id)
     sql = '''
       UPDATE sessions
       SET
@@ -118,32 +203,273 @@ CREATE TABLE sessions (
       WHERE id == ?;
     '''
     ts = unix.GetTime()
-    util.Database().Execute(sql, (ts, ts, unix.GetEnvInt('ASH_SESSION_ID'),))
+    util.Database().Execute(sql, (ts, ts, session_id))
 
 
 class Command(util.Database.Object):
-  """An abstraction of a command to store to the history database."""
-  def __init__(self, command, rval, start, finish, number, pipes):
+  """An abstraction of a command to store to the history database.
+
+  Commands of ASH_CFG_COMPRESS_MIN_SIZE bytes or more are stored zlib
+  compressed in the command_z column, leaving only a short preview in the
+  command column.  ash_query decompresses them transparently.
+
+  The program run by each command and its first argument are also stored, in
+  the indexed program and subcommand columns (see Tokenize).
+
+  The cwd index uses the default binary collation, so the history under a
+  directory can be found with a range query rather than a scan:
+
+    cwd >= '/some/dir/' AND cwd < '/some/dir0'  ('0' sorts right after '/')
+  """
+  upgrades = (
+    ('command_z', 'blob'),
+    ('program', 'varchar(64)'),
+    ('subcommand', 'varchar(64)'),
+  )
+  indexes = (
+    ('commands_program', 'program, subcommand'),
+    ('commands_cwd', 'cwd'),
+  )
+
+  # The number of characters of a compressed command kept in the command column.
+  PREVIEW_SIZE = 80
+
+  # The fields of each command written to a spool file by ash::log.
+  SPOOL_FIELDS = 8
+
+  # The longest program and subcommand names stored.
+  TOKEN_SIZE = 64
+
+  # Commands that run the command given as their arguments, mapped to those of
+  # their single letter options that take a separate value.
+  WRAPPERS = {
+    'builtin': '',
+    'command': '',
+    'env': 'CSu',
+    'exec': 'a',
+    'nice': 'n',
+    'nohup': '',
+    'sudo': 'CDTUghprtu',
+    'time': 'fo',
+  }
+
+  # Matches the environment variable assignments that may prefix a command.
+  assignment = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*=')
+  # Matches the shell operators that end a simple command.
+  operator = re.compile(r'[|&;<>()]')
+  # Matches an argument that can be a subcommand, like 'status' or 'get-pods'.
+  word = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.:-]*$')
+
+  def __init__(self, command=None, rval=None, start=None, finish=None,
+               number=None, pipes=None, cwd=None, oldpwd=None):
+    """Initialize a Command.
+
+    The working directories default to those of the current process, but are
+    given explicitly for commands that were spooled by the shell.
+    """
     util.Database.Object.__init__(self, 'commands')
-    self.values = {
+    self.command = command
+    self.rval = rval
+    self.start = start
+    self.finish = finish
+    self.number = number
+    self.pipes = pipes
+    self.cwd = cwd
+    self.oldpwd = oldpwd
+
+  def GetValues(self):
+    """Returns the command values, gathered only when they are inserted."""
+    values = {
       'session_id': unix.GetEnvInt('ASH_SESSION_ID'),
       'shell_level': unix.GetEnvInt('SHLVL'),
-      'command_no': number,
+      'command_no': self.number,
       'tty': unix.GetTTY(),
       'euid': unix.GetEUID(),
-      'cwd': unix.GetCWD(),
-      'rval': rval,
-      'start_time': start,
-      'end_time': finish,
-      'duration': finish - start,
-      'pipe_cnt': len(pipes.split('_')),
-      'pipe_vals': pipes,
-      'command': command
+      'cwd': self.cwd or unix.GetCWD(),
+      'rval': self.rval,
+      'start_time': self.start,
+      'end_time': self.finish,
+      'duration': self.finish - self.start,
+      'pipe_cnt': len(self.pipes.split('_')),
+      'pipe_vals': self.pipes,
     }
+    values['command'], values['command_z'] = Command.Compress(self.command)
+    values['program'], values['subcommand'] = Command.Tokenize(self.command)
+    if util.Database.GetShardCount():
+      values['id'] = util.Database.NewRowId('commands')
     # If the user changed directories, CWD will be the new directory, not the
     # one where the command was actually entered.
-    if rval == 0 and (command == 'cd' or command.startswith('cd ')):
-      self.values['cwd'] = unix.GetEnv('OLDPWD')
+    command = self.command
+    if self.rval == 0 and (command == 'cd' or command.startswith('cd ')):
+      values['cwd'] = self.cwd and self.oldpwd or unix.GetEnv('OLDPWD')
+    return values
+
+  @classmethod
+  def GetSpoolFile(cls):
+    """Returns the name of the spool file used by the current session."""
+    spool_dir = util.Config().GetString('SPOOL_DIR')
+    session_id = unix.GetEnv('ASH_SESSION_ID')
+    return spool_dir and session_id and os.path.join(spool_dir, session_id)
+
+  @classmethod
+  def ReadSpool(cls, filename):
+    """Returns the Commands saved to a spool file by ash::log.
+
+    Each command is written as SPOOL_FIELDS null-terminated values.  A command
+    that was only partly written is ignored.
+    """
+    if not filename or not os.path.exists(filename):
+      return []
+    with open(filename, 'rb') as fd:
+      fields = fd.read().decode('utf-8', 'replace').split('\0')
+    commands = []
+    size = Command.SPOOL_FIELDS
+    for i in range(0, len(fields) - size, size):
+      number, rval, start, finish, pipes, cwd, oldpwd, command = \
+          fields[i:i + size]
+      commands.append(Command(command, int(rval), int(start), int(finish),
+                              int(number), pipes, cwd, oldpwd))
+    return commands
+
+  @classmethod
+  def Tokenize(cls, command):
+    """Returns the (program, subcommand) run by a command.
+
+    The program is the name of the first command run, without its directory,
+    any environment variable assignments before it or any wrappers around it
+    (like sudo, env or nohup).  The subcommand is the argument following the
+    program, if that is a plain word, like 'status' in 'git status'.  Either
+    may be None.
+    """
+    try:
+      tokens = shlex.split(command)
+    except ValueError:
+      # Unbalanced quotes, most likely.
+      tokens = command.split()
+
+    tokens = iter(tokens)
+    options = None  # The options of the wrapper being skipped, if any.
+    for token in tokens:
+      if options is not None and token.startswith('-') and token != '-':
+        if token == '--':
+          options = None
+        elif len(token) == 2 and token[1] in options:
+          next(tokens, None)
+        continue
+      if cls.assignment.match(token):
+        continue
+      parts = [x for x in cls.operator.split(token) if x]
+      program = parts and os.path.basename(parts[0].rstrip('/'))
+      if not program:
+        continue
+      if program in cls.WRAPPERS:
+        options = cls.WRAPPERS[program]
+        continue
+
+      # The subcommand must be part of the same simple command.
+      subcommand = None
+      if len(parts) == 1 and not cls.operator.search(token[-1]):
+        argument = cls.operator.split(next(tokens, ''))[0]
+        if cls.word.match(argument):
+          subcommand = argument[:cls.TOKEN_SIZE]
+      return program[:cls.TOKEN_SIZE], subcommand
+    return None, None
+
+  @classmethod
+  def Compress(cls, command):
+    """Returns the (command, command_z) values to store for a command.
+
+    Short commands are stored as-is, with a null command_z.
+    """
+    min_size = util.Config().GetInt('COMPRESS_MIN_SIZE')
+    data = isinstance(command, bytes) and command or command.encode('utf-8')
+    if min_size <= 0 or len(data) < min_size:
+      return command, None
+    compressed = zlib.compress(data, 9)
+    preview = command[:Command.PREVIEW_SIZE]
+    if len(compressed) + len(preview) >= len(data):
+      return command, None
+    return preview, sqlite3.Binary(compressed)
+
+  @classmethod
+  def UpdateBatches(cls, select_sql, args=(), batch_size=1000):
+    """Yields the rows to update, one transaction per batch of rows.
+
+    The select_sql must select the id of each command first, in id order, and
+    take the last id seen before its args and the batch size after them.  The
+    caller updates each row before the next is yielded.  Committing each batch
+    separately keeps shells logging commands meanwhile from being blocked for
+    long.
+    """
+    last_id = 0
+    while True:
+      with util.Database.Transaction():
+        Command()  # Adds any missing columns to older databases.
+        util.Database.BeginWrite()
+        rows = util.Database().Fetch(
+            select_sql, (last_id,) + tuple(args) + (batch_size,))
+        for row in (rows or [None])[1:]:
+          last_id = row[0]
+          yield row
+      if not rows or len(rows) - 1 < batch_size:
+        return
+
+  @classmethod
+  def CompressAll(cls):
+    """Compresses the long commands already stored in the database.
+
+    Returns the number of commands compressed and their size before and after,
+    in bytes.
+    """
+    min_size = util.Config().GetInt('COMPRESS_MIN_SIZE')
+    if min_size <= 0:
+      return 0, 0, 0
+    select_sql = '''
+      SELECT id, command
+      FROM commands
+      WHERE
+        id > ?
+        AND command_z IS NULL
+        AND length(CAST(command AS BLOB)) >= ?
+      ORDER BY id
+      LIMIT ?;
+    '''
+    update_sql = 'UPDATE commands SET command = ?, command_z = ? WHERE id = ?;'
+    count = before = after = 0
+    for row_id, command in Command.UpdateBatches(select_sql, (min_size,)):
+      preview, compressed = Command.Compress(command)
+      if compressed is None:
+        continue
+      util.Database().Execute(update_sql, (preview, compressed, row_id))
+      count += 1
+      before += len(command.encode('utf-8'))
+      after += len(preview.encode('utf-8')) + len(compressed)
+    return count, before, after
+
+  @classmethod
+  def TokenizeAll(cls):
+    """Fills in the program and subcommand of the commands already stored.
+
+    Returns the number of commands updated.
+    """
+    select_sql = '''
+      SELECT id, inflate(command_z, command)
+      FROM commands
+      WHERE
+        id > ?
+        AND program IS NULL
+      ORDER BY id
+      LIMIT ?;
+    '''
+    update_sql = 'UPDATE commands SET program = ?, subcommand = ? WHERE id = ?;'
+    count = 0
+    for row_id, command in Command.UpdateBatches(select_sql):
+      program, subcommand = Command.Tokenize(command)
+      if program is None:
+        continue
+      util.Database().Execute(update_sql, (program, subcommand, row_id))
+      count += 1
+    return count
 
   def GetCreateTableSql(self):
     return '''
@@ -166,6 +492,179 @@ UNIQUE(session_id, command_no)
 )'''
 
 
+class Maintenance(util.Database.Object):
+  """A record of one database maintenance step and what it accomplished."""
+
+  def __init__(self, step, start, duration_ms, pages_reclaimed):
+    util.Database.Object.__init__(self, 'maintenance')
+    self.values = {
+      'step': step,
+      'start_time': start,
+      'duration_ms': duration_ms,
+      'pages_reclaimed': pages_reclaimed,
+    }
+
+  def GetCreateTableSql(self):
+    return '''
+CREATE TABLE maintenance (
+  id integer primary key autoincrement,
+  step varchar(20) not null,
+  start_time integer not null,
+  duration_ms integer not null,
+  pages_reclaimed integer not null
+)'''
+
+  @classmethod
+  def Claim(cls):
+    """Returns True if maintenance is due, claiming it for this process.
+
+    The interval is set by ASH_CFG_MAINTENANCE_INTERVAL (in seconds).  If it is
+    unset or zero, maintenance is never due.  A 'claim' step is recorded in the
+    same transaction as the check, so that when several sessions end at once,
+    only one of them maintains the database.  The write lock is only taken
+    (and the check made again) if maintenance looks due.
+    """
+    interval = util.Config().GetInt('MAINTENANCE_INTERVAL')
+    if interval <= 0:
+      return False
+    start = unix.GetTime()
+    with util.Database.Transaction():
+      claim = Maintenance('claim', start, 0, 0)
+      if not cls.IsDue(start, interval):
+        return False
+      util.Database.BeginWrite()
+      if not cls.IsDue(start, interval):
+        return False
+      claim.Insert()
+    return True
+
+  @classmethod
+  def IsDue(cls, now, interval):
+    """Returns True if no maintenance was started in the interval before now."""
+    rs = util.Database.Connect().execute(
+        'SELECT max(start_time) FROM maintenance').fetchone()
+    return not (rs[0] and rs[0] + interval > now)
+
+  @classmethod
+  def Run(cls, full):
+    """Runs each maintenance step, recording how long it took.
+
+    A full run also refreshes all the query planner statistics and, for
+    databases created before incremental auto_vacuum was enabled, rebuilds the
+    database once to enable it.  Returns the list of completed steps.
+    """
+    completed = []
+    if util.Database.GetShardCount():
+      start = unix.GetTime()
+      timer = time.time()
+      try:
+        moved, reclaimed = Maintenance.Compact()
+        duration_ms = int((time.time() - timer) * 1000)
+        logging.debug('Moved %d sessions from the shards.', moved)
+        Maintenance('compact', start, duration_ms, reclaimed).Insert()
+        completed.append(('compact', duration_ms, reclaimed))
+      except sqlite3.Error as e:
+        logging.warning('Maintenance step compact failed: %s', e)
+
+    db = util.Database.Connect()
+    steps = [('optimize', 'PRAGMA optimize')]
+    if full:
+      steps.append(('analyze', 'ANALYZE'))
+      if db.execute('PRAGMA auto_vacuum').fetchone()[0] == 0:
+        steps.append(('auto_vacuum', 'PRAGMA auto_vacuum = INCREMENTAL'))
+        steps.append(('vacuum', 'VACUUM'))
+    steps.append(('incremental_vacuum', 'PRAGMA incremental_vacuum'))
+    steps.append(('checkpoint', 'PRAGMA wal_checkpoint(TRUNCATE)'))
+
+    for step, sql in steps:
+      start = unix.GetTime()
+      pages = db.execute('PRAGMA page_count').fetchone()[0]
+      timer = time.time()
+      try:
+        db.execute(sql).fetchall()
+      except sqlite3.Error as e:
+        logging.warning('Maintenance step %s failed: %s', step, e)
+        continue
+      duration_ms = int((time.time() - timer) * 1000)
+      # Some steps (like ANALYZE) grow the database, which reclaims nothing.
+      reclaimed = max(pages - db.execute('PRAGMA page_count').fetchone()[0], 0)
+      logging.debug('Maintenance step %s took %d ms and reclaimed %d pages.',
+                   step, duration_ms, reclaimed)
+      Maintenance(step, start, duration_ms, reclaimed).Insert()
+      completed.append((step, duration_ms, reclaimed))
+    return completed
+
+  @classmethod
+  def Compact(cls):
+    """Moves the closed sessions (and their commands) from the shards into the
+    main database.
+
+    Open sessions are left in their shards, so shells logging commands are only
+    blocked while the move is made.  Returns the number of sessions moved and
+    the number of pages reclaimed from the shards.
+    """
+    # Make sure the main tables exist and are up to date.
+    db = util.Database.Connect()
+    Session()
+    Command()
+    attached = []
+    for shard in range(1, util.Database.GetShardCount() + 1):
+      filename = util.Database.GetFilename(shard)
+      if os.path.exists(filename):
+        db.execute('ATTACH DATABASE ? AS shard%d' % shard, (filename,))
+        attached.append('shard%d' % shard)
+
+    moved = reclaimed = 0
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      try:
+        for schema in attached:
+          moved += Maintenance.MoveClosedSessions(db, schema)
+        db.execute('COMMIT')
+      except:
+        db.execute('ROLLBACK')
+        raise
+      for schema in attached:
+        pages = db.execute('PRAGMA %s.page_count' % schema).fetchone()[0]
+        db.execute('PRAGMA %s.incremental_vacuum' % schema).fetchall()
+        reclaimed += max(pages - db.execute(
+            'PRAGMA %s.page_count' % schema).fetchone()[0], 0)
+    finally:
+      for schema in attached:
+        db.execute('DETACH DATABASE %s' % schema)
+    return moved, reclaimed
+
+  @classmethod
+  def MoveClosedSessions(cls, db, schema):
+    """Moves the closed sessions in a shard into the main database.
+
+    Returns the number of sessions moved.
+    """
+    tables = [row[0] for row in db.execute(
+        "SELECT name FROM %s.sqlite_master WHERE type = 'table'" % schema)]
+    if 'sessions' not in tables:
+      return 0
+    closed = 'SELECT id FROM %s.sessions WHERE end_time IS NOT NULL' % schema
+    moves = [('sessions', 'id')]
+    if 'commands' in tables:
+      moves.append(('commands', 'session_id'))
+
+    moved = 0
+    for table, key in moves:
+      info = db.execute('PRAGMA %s.table_info(%s)' % (schema, table))
+      columns = ', '.join([row[1] for row in info])
+      cursor = db.execute(
+          'INSERT INTO main.%s ( %s ) SELECT %s FROM %s.%s WHERE %s IN ( %s )'
+          % (table, columns, columns, schema, table, key, closed))
+      if table == 'sessions':
+        moved = cursor.rowcount
+    # The sessions are deleted last, since they select the commands to delete.
+    for table, key in reversed(moves):
+      db.execute('DELETE FROM %s.%s WHERE %s IN ( %s )' % (
+          schema, table, key, closed))
+    return moved
+
+
 def main(argv):
   # If ASH_DISABLED is set, we skip everything and exit without error.
   if os.getenv('ASH_DISABLED'): return 0
@@ -189,29 +688,95 @@ def main(argv):
   if len(argv) == 1 and not util.Config().GetBool('HIDE_USAGE_FOR_NO_ARGS'):
     flags.PrintHelp()
 
-  # Create the session id, if not already set in the environment.
-  session_id = os.getenv('ASH_SESSION_ID')
+  # All the database work done by this invocation shares one connection and is
+  # committed in a single transaction.
+  with util.Database.Transaction():
+    # Create the session id, if not already set in the environment.  Sharded
+    # sessions need ids that are unique across the shards.
+    session_id = os.getenv('ASH_SESSION_ID')
+    if flags.get_session_id:
+      local = util.Database.GetShardCount() or \
+          util.Config().GetBool('LOCAL_SESSION_IDS')
+      if session_id is None and local:
+        session_id = Session.NewLocalId()
+      elif session_id is None:
+        session_id = Session().Insert()
+
+    # Each locally generated session writes to its own shard, if enabled.
+    # Nothing has been written yet in that case, so the connection is unused.
+    key = session_id and int(session_id) or 0
+    if Session.IsLocalId(key):
+      util.Database.UseShard(key)
+
+    # Gather any commands spooled by the shell.
+    commands = []
+    spool = flags.flush_spool and Command.GetSpoolFile()
+    if spool:
+      commands.extend(Command.ReadSpool(spool))
+
+    # Insert a new command into the database, if one was supplied.
+    command_flag_used = bool(flags.command
+      or flags.command_exit
+      or flags.command_pipe_status
+      or flags.command_start
+      or flags.command_finish
+      or flags.command_number)
+    if command_flag_used:
+      commands.append(Command(
+        flags.command, flags.command_exit, flags.command_start,
+        flags.command_finish, flags.command_number, flags.command_pipe_status
+      ))
+
+    if commands and Session.IsLocalId(unix.GetEnvInt('ASH_SESSION_ID')):
+      Session.InsertLocal(unix.GetEnvInt('ASH_SESSION_ID'))
+    for command in commands:
+      command.Insert()
+
+    # End the current session.
+    if flags.end_session:
+      Session.Close()
+
+  # The new session id is only emitted once it has been committed.
   if flags.get_session_id:
-    if session_id is None:
-      session_id = Session().Insert()
     print(session_id)
 
-  # Insert a new command into the database, if one was supplied.
-  command_flag_used = bool(flags.command
-    or flags.command_exit
-    or flags.command_pipe_status
-    or flags.command_start
-    or flags.command_finish
-    or flags.command_number)
-  if command_flag_used:
-    Command(
-      flags.command, flags.command_exit, flags.command_start,
-      flags.command_finish, flags.command_number, flags.command_pipe_status
-    ).Insert()
-
-  # End the current session.
-  if flags.end_session:
-    Session().Close()
+  # The spooled commands were committed, so the spool file can be removed.
+  if spool and os.path.exists(spool):
+    os.remove(spool)
+
+  # The rest of the work is done on the main database.
+  util.Database.UseShard(0)
+
+  # Upgrade previously logged commands to the current storage format.
+  if flags.upgrade:
+    print('Found the program run by %d commands.' % Command.TokenizeAll())
+    count, before, after = Command.CompressAll()
+    print('Compressed %d commands from %d to %d bytes (%d bytes saved).' % (
+        count, before, after, before - after))
+    if count:
+      print('Use --maintain to return the freed space to the filesystem.')
+
+  # Maintain the database when asked, or occasionally when a session ends.  The
+  # latter is done in the background, so that the shell can exit at once.
+  if flags.maintain:
+    try:
+      for step, duration_ms, reclaimed in Maintenance.Run(True):
+        print('%-20s %6d ms %8d pages reclaimed' % (
+            step, duration_ms, reclaimed))
+    finally:
+      util.Database.Close()
+  elif flags.end_session and Maintenance.Claim():
+    try:
+      detached = unix.Detach()
+    except OSError as e:
+      logging.warning('Failed to start the database maintenance: %s', e)
+      detached = False
+    if detached:
+      try:
+        Maintenance.Run(False)
+      except Exception:
+        logging.exception('The database maintenance failed.')
+      os._exit(0)
 
   # Return the desired exit code.
   return flags.exit
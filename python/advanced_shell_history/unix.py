@@ -28,6 +28,40 @@ class Error(Exception):
   pass
 
 
+def _Memoize(function):
+  """Caches the result of a function, which is only called the first time."""
+  cache = []
+  def Memoized():
+    if not cache:
+      cache.append(function())
+    return cache[0]
+  Memoized.__doc__ = function.__doc__
+  return Memoized
+
+
+def Detach():
+  """Forks a child process, detached from the parent and its terminal.
+
+  Returns True in the child and False in the parent, which does not wait for the
+  child to finish.  The standard streams of the child are redirected to
+  /dev/null.
+  """
+  sys.stdout.flush()
+  sys.stderr.flush()
+  pid = os.fork()
+  if pid:
+    # The intermediate child exits at once, leaving the grandchild orphaned.
+    os.waitpid(pid, 0)
+    return False
+  os.setsid()
+  if os.fork():
+    os._exit(0)
+  devnull = os.open(os.devnull, os.O_RDWR)
+  for fd in (0, 1, 2):
+    os.dup2(devnull, fd)
+  return True
+
+
 def GetCWD():
   """Returns the current working directory."""
   return os.getcwd()
@@ -87,6 +121,7 @@ def _ParseIfconfig():
   return devices
 
 
+@_Memoize
 def GetHostIp():
   """Returns the ip addresses for this host."""
   ips = []
@@ -102,6 +137,7 @@ def GetHostName():
   return socket.gethostname()
 
 
+@_Memoize
 def GetLoginName():
   """Returns the user login name."""
   return pwd.getpwuid(os.getuid())[0]
@@ -117,14 +153,27 @@ def GetPPID():
   return _GetProcStat(3)
 
 
-def _GetProcStat(num):
-  """Returns the i'th field of /proc/<pid>/stat of the shell."""
+@_Memoize
+def _ReadProcStat():
+  """Returns the fields of /proc/<pid>/stat of the shell, read only once."""
   stat_file = '/proc/%d/stat' % os.getppid()
   if not os.path.exists(stat_file):
-    return ''
+    return []
   with open(stat_file) as fd:
     data = fd.read()
-    return data.split(' ', num + 1)[num]
+  # The second field is the parenthesized process name, which may contain
+  # spaces, so it is split out on its own.
+  name_start, name_end = data.find('('), data.rfind(')') + 1
+  return ([data[:name_start].strip(), data[name_start:name_end]] +
+          data[name_end:].split())
+
+
+def _GetProcStat(num):
+  """Returns the i'th field of /proc/<pid>/stat of the shell."""
+  fields = _ReadProcStat()
+  if num < len(fields):
+    return fields[num]
+  return ''
 
 
 def GetShell():
@@ -142,6 +191,7 @@ def GetTimeZone():
   return time.tzname[time.localtime()[8]]
 
 
+@_Memoize
 def GetTTY():
   """Return the name of the current controlling tty."""
   tty_name = os.ttyname(sys.stdin.fileno())
@@ -24,9 +24,15 @@ __version__ = '0.8r1'
 
 
 import argparse
+import collections
+import contextlib
 import logging
 import os
+import re
 import sqlite3
+import sys
+import time
+import zlib
 
 
 class Flags(argparse.ArgumentParser):
@@ -87,6 +93,10 @@ class Config(object):
     value = self.GetString(variable)
     return value and value.strip() == 'true'
 
+  def GetInt(self, variable):
+    """Returns an int value for a config variable, or 0 if not set."""
+    return int(self.GetString(variable) or 0)
+
   def GetString(self, variable):
     """Returns a string value for a config variable, or None if not set."""
     if self.Sets(variable):
@@ -123,65 +133,552 @@ def InitLogging():
   logging.basicConfig(**kwargs)
 
 
+def _CompilePattern(pattern, flags=0):
+  """Returns the compiled regular expression, caching the most recent ones.
+
+  Regular expressions used in queries are applied to every row, so they are
+  compiled once and cached, evicting the oldest when the cache is full.  A scan
+  applies the same pattern to every row, so the last one used is checked first.
+  """
+  last = _CompilePattern.last
+  if last[0] == pattern and last[1] == flags:
+    return last[2]
+  cache = _CompilePattern.cache
+  compiled = cache.get((pattern, flags))
+  if compiled is None:
+    compiled = re.compile(pattern, flags)
+    if len(cache) >= _CompilePattern.max_size:
+      cache.popitem(last=False)
+    cache[(pattern, flags)] = compiled
+  _CompilePattern.last = (pattern, flags, compiled)
+  return compiled
+
+_CompilePattern.cache = collections.OrderedDict()
+_CompilePattern.last = (None, None, None)
+_CompilePattern.max_size = 64
+
+
+def _Inflate(data, default):
+  """Implements inflate(data, default): the zlib decompressed text of data.
+
+  If data is null, the default is returned instead.
+  """
+  if data is None:
+    return default
+  return zlib.decompress(bytes(data)).decode('utf-8')
+
+
+def _Regexp(pattern, value):
+  """Implements the sqlite REGEXP operator: value REGEXP pattern."""
+  return value is not None and bool(_CompilePattern(pattern).search(value))
+
+
+def _IRegexp(pattern, value):
+  """A case-insensitive version of REGEXP: iregexp(pattern, value)."""
+  return value is not None and bool(
+      _CompilePattern(pattern, re.IGNORECASE).search(value))
+
+
 class Database(object):
-  """A wrapper around a database connection."""
+  """A wrapper around a database connection.
+
+  All Database instances in a process share a single connection, which is
+  opened lazily on first use.  Code that writes to the database should do so
+  within a Transaction, so that all the work done by one invocation is
+  committed at once.
+
+  If ASH_CFG_SHARDS is set, the history may also be written to that many shard
+  databases next to the main one (history.1.db, history.2.db, ...), so that
+  concurrent shells do not all queue on one write lock.  A writer picks its
+  shard with UseShard.  Readers set read_shards to have the shards attached to
+  the connection and presented, along with the main database, as a single set
+  of tables (see ShadowTable).
+  """
+
+  # sqlite attaches at most 10 databases to a connection (by default).
+  MAX_SHARDS = 10
+
+  # Sharded row ids hold the shard number in their low bits (see NewRowId).
+  SHARD_BITS = 4
 
   # The name of the sqlite3 file backing the saved command history.
   filename = None
 
+  # The connection shared by every Database instance in this process.
+  _connection = None
+
+  # True while a Transaction is open.
+  _in_transaction = False
+
+  # True once the write lock of the open Transaction has been taken.
+  _writing = False
+
+  # The names of the tables whose schema has already been checked.
+  _checked_tables = set()
+
+  # The shard written to by this process, or 0 for the main database.
+  shard = 0
+
+  # True to attach the shards when connecting, to read the whole history.
+  read_shards = False
+
+  # True to connect to a copy of the history in memory (see Snapshot).
+  snapshot = False
+
+  # The schema names of the shards attached to the connection.
+  _attached = []
+
   class Object(object):
-    """A construct for objects to be inserted into the Database."""
+    """A construct for objects to be inserted into the Database.
+
+    Subclasses define the original schema of their table in GetCreateTableSql.
+    Columns added to the table later are listed in upgrades, as pairs of column
+    name and definition, and indexes are listed in indexes, as pairs of index
+    name and indexed columns.  Tables created by older versions are upgraded in
+    place the first time an object is created.
+    """
+    upgrades = ()
+    indexes = ()
+
     def __init__(self, table_name):
       self.values = {}
       self.table_name = table_name
+      if table_name in Database._checked_tables:
+        return
+      # Check that the table exists, creating or upgrading it if needed.  The
+      # write lock is only taken (and the schema checked again) if the table
+      # must be changed.
+      cur = Database().cursor
+      try:
+        if not self.CheckSchema(cur, False):
+          Database.BeginWrite()
+          self.CheckSchema(cur, True)
+        Database._checked_tables.add(table_name)
+      finally:
+        cur.close()
+
+    def CheckSchema(self, cur, upgrade):
+      """Returns True if the table is up to date.
+
+      If upgrade is set, the table is first created or upgraded, as needed.
+      """
       sql = '''
-        select sql
+        select type, name, sql
         from sqlite_master
         where
-          type = 'table'
-          and name = ?;
+          tbl_name = ?;
       '''
-      # Check that the table exists, creating it if not.
-      db = Database()
-      cur = db.cursor
-      try:
-        cur.execute(sql, (table_name,))
-        rs = cur.fetchone()
-        if not rs:
-          cur.execute(self.GetCreateTableSql() + ';')
-          db.connection.commit()
-        elif rs[0] != self.GetCreateTableSql().strip():
-          logging.warning('Table %s exists, but has an unexpected schema.',
-                          table_name)
-      finally:
-        cur.close()
+      table_name = self.table_name
+      cur.execute(sql, (table_name,))
+      schema = dict([(name, text) for _, name, text in cur.fetchall()])
+      create_sql = self.GetCreateTableSql().strip()
+      if table_name not in schema:
+        if not upgrade:
+          return False
+        cur.execute(create_sql + ';')
+        schema[table_name] = create_sql
+
+      # Add any columns missing from older versions of the table.  sqlite
+      # splices the new column definitions into the stored table sql, so they
+      # are removed again before checking the rest of the schema.
+      stored_sql = schema[table_name]
+      cur.execute('PRAGMA table_info(%s)' % table_name)
+      columns = [row[1] for row in cur.fetchall()]
+      for column, definition in self.upgrades:
+        if column in columns:
+          stored_sql = stored_sql.replace(
+              ', %s %s' % (column, definition), '', 1)
+        elif not upgrade:
+          return False
+        else:
+          cur.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+              table_name, column, definition))
+
+      for index, indexed_columns in self.indexes:
+        if index in schema:
+          continue
+        if not upgrade:
+          return False
+        cur.execute('CREATE INDEX %s ON %s (%s)' % (
+            index, table_name, indexed_columns))
+
+      if stored_sql != create_sql:
+        logging.warning('Table %s exists, but has an unexpected schema.',
+                        table_name)
+      return True
+
+    def GetValues(self):
+      """Returns a dict of the column values to insert.
+
+      Subclasses may override this to gather their values lazily, so that no
+      work is done unless the object is actually inserted.
+      """
+      return self.values
 
     def Insert(self):
       """Insert the object into the database, returning the new rowid."""
+      values = self.GetValues()
       sql = 'INSERT INTO %s ( %s ) VALUES ( %s )' % (
         self.table_name,
-        ', '.join(self.values),
-        ', '.join(['?' for _ in self.values])
+        ', '.join(values),
+        ', '.join(['?' for _ in values])
       )
-      return Database().Execute(sql, tuple(self.values.values()))
+      return Database().Execute(sql, tuple(values.values()))
 
   def __init__(self):
-    """Initialize a Database with an open connection to the history database."""
-    if Database.filename is None:
-      Database.filename = Config().GetString('HISTORY_DB')
-    self.connection = sqlite3.connect(Database.filename)
-    self.connection.row_factory = sqlite3.Row
+    """Initialize a Database using the shared history database connection."""
+    self.connection = Database.Connect()
     self.cursor = self.connection.cursor()
+    # The error raised by the last failed Fetch, if any.
+    self.error = None
+
+  @classmethod
+  def Connect(cls):
+    """Returns the shared connection, opening it if necessary.
+
+    The connection is in autocommit mode unless a Transaction is open, in which
+    case the write lock is taken just before the first write (see BeginWrite).
+
+    New databases are created with incremental auto_vacuum enabled, so that
+    maintenance can return free pages without rewriting the whole file.
+    """
+    if cls._connection is None and cls.snapshot:
+      cls.Snapshot()
+    if cls._connection is None:
+      filename = cls.GetFilename()
+      is_new = not os.path.exists(filename) or not os.path.getsize(filename)
+      cls._connection = sqlite3.connect(filename, isolation_level=None)
+      cls.Configure(cls._connection)
+      if is_new:
+        cls._connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+      if cls.read_shards:
+        cls.AttachShards()
+    return cls._connection
+
+  @classmethod
+  def BeginWrite(cls):
+    """Takes the write lock for the open Transaction, if not already taken.
+
+    This is called just before the first write, rather than when connecting,
+    so that the lock is not held while the values to write are gathered.
+    Anything read before this may have been changed by another writer.
+    """
+    if cls._in_transaction and not cls._writing:
+      cls.Connect().execute('BEGIN IMMEDIATE')
+      cls._writing = True
+
+  @classmethod
+  def Configure(cls, connection):
+    """Sets up a new connection with the SQL functions used by the queries."""
+    connection.row_factory = sqlite3.Row
+    connection.create_function('regexp', 2, _Regexp)
+    connection.create_function('iregexp', 2, _IRegexp)
+    connection.create_function('inflate', 2, _Inflate)
+
+  @classmethod
+  def Snapshot(cls):
+    """Replaces the connection with a copy of the database held in memory.
+
+    Queries made afterward see a consistent copy of the history, read without
+    touching the disk or waiting on shells logging commands.  The copy is made
+    with the sqlite backup API when available (Python 3.7 and later) and with
+    CopyDatabase otherwise.  When reading shards, they are merged into the copy.
+    """
+    cls.Close()
+    memory = sqlite3.connect(':memory:', isolation_level=None)
+    cls.Configure(memory)
+    if hasattr(memory, 'backup'):
+      source = sqlite3.connect(cls.GetFilename(0))
+      try:
+        source.backup(memory)
+      finally:
+        source.close()
+    else:
+      cls.CopyDatabase(memory, cls.GetFilename(0))
+
+    shards = cls.read_shards and cls.GetShardCount() or 0
+    for shard in range(1, shards + 1):
+      filename = cls.GetFilename(shard)
+      if os.path.exists(filename):
+        cls.MergeShard(memory, filename)
+    cls._connection = memory
+
+  @classmethod
+  def CopyDatabase(cls, connection, filename):
+    """Copies the tables and indexes of a database into an empty connection.
+
+    The rows are copied within sqlite, in one transaction, which is much faster
+    than replaying a dump of the database one statement at a time.
+    """
+    connection.execute('ATTACH DATABASE ? AS source', (filename,))
+    try:
+      connection.execute('BEGIN')
+      try:
+        sql = '''
+          SELECT type, name, sql
+          FROM source.sqlite_master
+          WHERE
+            type IN ('table', 'index')
+            AND sql NOT NULL
+            AND name NOT LIKE 'sqlite_%'
+          ORDER BY type = 'index';
+        '''
+        # The indexes are created after the rows are copied, which is faster.
+        for kind, name, create_sql in connection.execute(sql).fetchall():
+          connection.execute(create_sql)
+          if kind == 'table':
+            connection.execute(
+                'INSERT INTO main.%s SELECT * FROM source.%s' % (name, name))
+        connection.execute('COMMIT')
+      except:
+        connection.execute('ROLLBACK')
+        raise
+    finally:
+      connection.execute('DETACH DATABASE source')
+
+  @classmethod
+  def MergeShard(cls, connection, filename):
+    """Copies the commands and sessions in a shard into the main database."""
+    connection.execute('ATTACH DATABASE ? AS shard', (filename,))
+    try:
+      sql = '''
+        SELECT name, sql
+        FROM shard.sqlite_master
+        WHERE type = 'table' AND name IN ('commands', 'sessions');
+      '''
+      for table, create_sql in connection.execute(sql).fetchall():
+        info = 'PRAGMA %s.table_info(%s)'
+        columns = [row[1] for row in connection.execute(info % ('main', table))]
+        if not columns:
+          connection.execute(create_sql)
+        shard_columns = [row[1] for row in
+                         connection.execute(info % ('shard', table))]
+        columns = ', '.join([x for x in columns or shard_columns
+                             if x in shard_columns])
+        connection.execute(
+            'INSERT INTO main.%s ( %s ) SELECT %s FROM shard.%s' % (
+                table, columns, columns, table))
+    finally:
+      connection.execute('DETACH DATABASE shard')
+
+  @classmethod
+  def GetFilename(cls, shard=None):
+    """Returns the name of the history database file.
+
+    Args:
+      shard: The shard whose file is returned (0 for the main database).  This
+          defaults to the shard written to by this process.
+    """
+    if cls.filename is None:
+      cls.filename = Config().GetString('HISTORY_DB')
+    if shard is None:
+      shard = cls.shard
+    if not shard:
+      return cls.filename
+    root, ext = os.path.splitext(cls.filename)
+    return '%s.%d%s' % (root, shard, ext)
+
+  @classmethod
+  def GetShardCount(cls):
+    """Returns the number of shards configured, or 0 if sharding is disabled."""
+    shards = Config().GetInt('SHARDS')
+    if shards > cls.MAX_SHARDS:
+      logging.debug('Using %d shards, not %d.', cls.MAX_SHARDS, shards)
+      return cls.MAX_SHARDS
+    return max(shards, 0)
+
+  @classmethod
+  def UseShard(cls, key):
+    """Directs the writes made by this process to the shard for a key.
+
+    Every writer using the same key uses the same shard.  The key is hashed,
+    so that keys with a common pattern are still spread over the shards.  If
+    the key is 0 or sharding is disabled, the main database is used.  This
+    closes the connection if it was open to another database, so it must not
+    be called within a Transaction.
+    """
+    shards = cls.GetShardCount()
+    shard = 0
+    if shards and key:
+      shard = (zlib.crc32(str(key).encode('utf-8')) & 0xffffffff) % shards + 1
+    if shard != cls.shard:
+      cls.Close()
+      cls.shard = shard
+
+  @classmethod
+  def NewRowId(cls, table):
+    """Returns the row id to use for a new row while sharding is enabled.
+
+    Row ids are the current time in microseconds, with the shard number (0 for
+    the main database) in the low SHARD_BITS bits.  This keeps the ids unique
+    across shards (and in the order the rows were inserted, give or take
+    concurrent inserts), so rows can be moved into the main database unchanged.
+    """
+    cls.BeginWrite()
+    row_id = (int(time.time() * 1000000) << cls.SHARD_BITS) | cls.shard
+    last_id = cls.Connect().execute(
+        'SELECT max(id) FROM %s' % table).fetchone()[0]
+    if last_id and last_id >= row_id:
+      row_id = last_id + (1 << cls.SHARD_BITS)
+    return row_id
+
+  @classmethod
+  def AttachShards(cls):
+    """Attaches the existing shard databases to the connection.
+
+    The commands and sessions tables of the main database and the shards are
+    then combined into temporary views, so that queries see a single table.
+    """
+    connection = cls.Connect()
+    for shard in range(1, cls.GetShardCount() + 1):
+      filename = cls.GetFilename(shard)
+      if not os.path.exists(filename):
+        continue
+      schema = 'shard%d' % shard
+      try:
+        connection.execute('ATTACH DATABASE ? AS %s' % schema, (filename,))
+        cls._attached.append(schema)
+      except sqlite3.Error as e:
+        logging.warning('Failed to attach %s: %s', filename, e)
+    for table in ('commands', 'sessions'):
+      cls.ShadowTable(table)
+
+  @classmethod
+  def GetChangeStamp(cls):
+    """Returns a value that changes whenever the database is written to.
+
+    This only stats the database files (and their write-ahead logs, if any),
+    so it is much cheaper than opening the database.  When reading shards,
+    every shard is included.
+    """
+    stamp = []
+    shards = cls.read_shards and cls.GetShardCount() or 0
+    names = []
+    for shard in range(shards + 1):
+      filename = cls.GetFilename(shard)
+      names.extend((filename, filename + '-wal'))
+    for name in names:
+      try:
+        st = os.stat(name)
+        stamp.append((st.st_ino, st.st_size, st.st_mtime))
+      except OSError:
+        stamp.append(None)
+    return tuple(stamp)
+
+  @classmethod
+  def GetHighWaterMark(cls):
+    """Returns the id of the most recently inserted command.
+
+    This is 0 when there are no commands and None if the commands table can't
+    be read.  Each attached shard is checked separately, since the maximum id
+    of the combined view can only be found by reading every command.
+    """
+    connection = cls.Connect()
+    high_water = None
+    for schema in ['main'] + cls._attached:
+      try:
+        sql = 'SELECT max(id) FROM %s.commands' % schema
+        rs = connection.execute(sql).fetchone()
+      except sqlite3.Error as e:
+        logging.debug('failed to get the high water mark: %r', e)
+        continue
+      high_water = max(high_water or 0, rs[0] or 0)
+    return high_water
+
+  @classmethod
+  def ShadowTable(cls, table, conditions=()):
+    """Restricts the rows of a table seen by subsequent queries.
+
+    A temporary view with the same name as the table is created, which takes
+    precedence over the table for any query that does not explicitly name the
+    main schema.  This lets saved queries be narrowed without rewriting their
+    SQL.
+
+    The view also decompresses columns: if the table has both a column X and a
+    column X_z, the view shows the inflated X_z value as X (when set).  The
+    conditions see the decompressed values.  If shards are attached, the view
+    combines the table in the main database with those in the shards.  Calling
+    this with no conditions removes the view, unless it is still needed to
+    decompress columns or combine shards.
+    """
+    connection = cls.Connect()
+    connection.execute('DROP VIEW IF EXISTS temp.%s' % table)
+    sources = []
+    columns = []
+    for schema in ['main'] + cls._attached:
+      names = [row[1] for row in connection.execute(
+          'PRAGMA %s.table_info(%s)' % (schema, table))]
+      if names:
+        sources.append((schema, names))
+        columns.extend([x for x in names if x not in columns])
+    compressed = [x for x in columns if x + '_z' in columns]
+    if not columns or not (conditions or compressed or len(sources) > 1):
+      return
+
+    selects = []
+    for schema, names in sources:
+      # Columns added by newer versions may be missing from some databases.
+      value = lambda column: column in names and column or 'NULL'
+      select = []
+      for column in columns:
+        if column in compressed:
+          select.append('inflate(%s, %s) AS %s' % (
+              value(column + '_z'), value(column), column))
+        elif not (column.endswith('_z') and column[:-2] in compressed):
+          select.append('%s AS %s' % (value(column), column))
+      selects.append('SELECT %s FROM %s.%s' % (
+          ', '.join(select), schema, table))
+    sql = 'CREATE TEMP VIEW %s AS SELECT * FROM ( %s )' % (
+        table, ' UNION ALL '.join(selects))
+    if conditions:
+      sql += ' WHERE ' + ' AND '.join(['( %s )' % x for x in conditions])
+    connection.execute(sql)
+
+  @classmethod
+  def Close(cls):
+    """Closes the shared connection, if it is open."""
+    if cls._connection is not None:
+      cls._connection.close()
+      cls._connection = None
+      cls._checked_tables = set()
+      cls._attached = []
+    cls._writing = False
+
+  @classmethod
+  @contextlib.contextmanager
+  def Transaction(cls):
+    """A context in which all database writes are made in one transaction.
+
+    The connection is only opened if something within the context uses the
+    database, and the write lock is only taken once something is written.  The
+    transaction is committed when the context exits normally and rolled back
+    if an exception is raised.  Either way, the connection is closed afterward.
+    """
+    cls._in_transaction = True
+    try:
+      yield
+      if cls._writing:
+        cls._connection.execute('COMMIT')
+    except:
+      if cls._writing:
+        try:
+          cls._connection.execute('ROLLBACK')
+        except sqlite3.Error as e:
+          logging.debug('rollback failed: %r', e)
+      raise
+    finally:
+      cls._in_transaction = False
+      cls.Close()
 
   def Execute(self, sql, values):
     try:
+      Database.BeginWrite()
       self.cursor.execute(sql, values)
       logging.debug('executing query: %s, values = %r', sql, values)
       return self.cursor.lastrowid
     except sqlite3.IntegrityError as e:
       logging.debug('constraint violation: %r', e)
     finally:
-      self.connection.commit()
       self.cursor.close()
     return 0
 
@@ -194,7 +691,7 @@ class Database(object):
     if self.SanityCheck(sql):
       try:
         self.cursor.execute(sql, params)
-        row = self.cursor.fetchone()
+        first = row = self.cursor.fetchone()
         if not row: return None
         headings = tuple(row.keys())
         fetched = 1
@@ -208,10 +705,11 @@ class Database(object):
             rows.append(row)
             fetched += 1
         rows.insert(0, headings)
-        rows.insert(1, row)
+        rows.insert(1, first)
         return rows
       except sqlite3.Error as e:
-        print >> sys.stderr, 'Failed to execute query: %s (%s)' % (sql, params)
+        sys.stderr.write('Failed to execute query: %s (%s)\n' % (sql, params))
+        self.error = e
         return None
       finally:
         self.cursor.close()
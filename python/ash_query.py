@@ -28,9 +28,18 @@ __version__ = '0.8r1'
 
 
 import csv
+import hashlib
+import logging
 import os
 import re
+import sqlite3
 import sys
+import time
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
 
 # Allow the local advanced_shell_history library to be imported.
 _LIB = '/usr/local/lib'
@@ -40,21 +49,31 @@ if _LIB not in sys.path:
 from advanced_shell_history import util
 
 
+# How far below the high water mark --follow looks for sharded commands that
+# were committed late: a minute, in sharded ids.
+FOLLOW_WINDOW = (60 * 1000000) << util.Database.SHARD_BITS
+
+
 class Flags(util.Flags):
   """A class to manage all the flags for the command logger."""
 
   arguments = (
     ('d', 'database', 'DB', str, 'a history database to query'),
     ('f', 'format', 'FMT', str, 'a format to display results'),
+    ('g', 'grep', 'REGEX', str, 'only include commands matching a regex'),
     ('l', 'limit', 'LINES', int, 'a limit to the number of lines returned'),
     ('p', 'print_query', 'NAME', str, 'print the query SQL'),
-    ('q', 'query', 'NAME', str, 'the name of the saved query to execute'),
+    ('q', 'query', 'NAMES', str, 'the names of the saved queries to execute'),
+    ('s', 'script', 'FILE', str, 'a file naming the saved queries to execute'),
   )
 
   flags = (
     ('F', 'list_formats', 'display all available formats'),
     ('H', 'hide_headings', 'hide column headings from query results'),
+    ('I', 'ignore_case', 'make --grep matching case-insensitive'),
     ('Q', 'list_queries', 'display all saved queries'),
+    ('S', 'snapshot', 'run the queries on a copy of the database in memory'),
+    ('T', 'follow', 'keep printing results for newly logged commands'),
   )
 
   def __init__(self):
@@ -115,6 +134,19 @@ class Queries(object):
     sql = os.popen('/bin/cat <<EOF_ASH_SQL\n%s\nEOF_ASH_SQL' % raw).read()
     return (raw, sql)
 
+  @classmethod
+  def GetNames(cls, names=None, script=None):
+    """Returns the query names given on the command line and in a script.
+
+    Names are separated by commas or whitespace.  In the script file, anything
+    following a '#' on a line is ignored.
+    """
+    text = names or ''
+    if script:
+      with open(script) as fd:
+        text += '\n' + '\n'.join([x.split('#')[0] for x in fd.readlines()])
+    return [x for x in re.split(r'[\s,]+', text) if x]
+
   @classmethod
   def PrintQueries(cls):
     data = sorted([(query, desc) for query, (desc, _) in cls.queries.items()])
@@ -122,6 +154,191 @@ class Queries(object):
     AlignedFormatter.PrintRows(data)
 
 
+class ResultCache(object):
+  """A size-bounded, on-disk cache of saved query results.
+
+  Entries are keyed by the expanded SQL of a query, the conditions applied to
+  the commands it sees and the row limit.  Each entry remembers the database
+  change stamp and command high water mark it was computed from.  An entry is
+  reused as-is while the database is unchanged.  For queries that list commands
+  in id order, new commands are fetched and appended to the cached rows rather
+  than re-running the query, as long as the commands the entry already covers
+  are still there (see GetCoverage): if any were removed, it is run again.
+
+  The cache is stored in ASH_CFG_QUERY_CACHE_DIR and is limited to
+  ASH_CFG_QUERY_CACHE_SIZE kilobytes, evicting the least recently used entries
+  first.  If the size is unset or zero, caching is disabled.  Queries that fail,
+  or whose results depend on the time or on random values, are not cached.
+  """
+  # Queries whose results can be extended by appending newer commands.
+  appendable = re.compile(r'order\s+by\s+(\w+\.)?id\s*;?\s*$', re.I)
+  # Query features that make a result depend on more than the rows appended.
+  not_appendable = re.compile(r"""
+    \b(
+      sessions | distinct | group | limit | over |
+      avg | count | group_concat | max | min | sum | total
+    )\b""", re.I | re.VERBOSE)
+  # Query features that give different results without any database change.
+  uncacheable = re.compile(r"""
+    'now' |
+    \b(
+      current_date | current_time | current_timestamp | random | randomblob
+    )\b""", re.I | re.VERBOSE)
+
+  @classmethod
+  def GetDirectory(cls):
+    config = util.Config()
+    if config.GetInt('QUERY_CACHE_SIZE') <= 0:
+      return None
+    return (config.GetString('QUERY_CACHE_DIR') or
+            os.path.join(os.getenv('HOME'), '.ash', 'cache'))
+
+  @classmethod
+  def IsCacheable(cls, sql):
+    """Returns True if the results of the sql only change with the database."""
+    return not cls.uncacheable.search(sql)
+
+  @classmethod
+  def IsAppendable(cls, sql):
+    """Returns True if new commands only ever add rows to the end of the sql."""
+    return bool(cls.appendable.search(sql) and
+                not cls.not_appendable.search(sql))
+
+  @classmethod
+  def Fetch(cls, sql, limit=None, conditions=(), stamp=None):
+    """Returns the result set of the sql, using cached results when possible.
+
+    The conditions are SQL expressions restricting the commands seen by the
+    query (see Database.ShadowTable).  If the query reads a snapshot of the
+    database, stamp must be the change stamp taken before the snapshot was.
+    """
+    directory = cls.GetDirectory()
+    if not directory or not util.Database.SanityCheck(sql) or \
+        not cls.IsCacheable(sql):
+      return cls.FetchRange(sql, None, None, limit, conditions)
+    if limit is not None and limit <= 0:
+      limit = None
+
+    key = repr((util.Database.GetFilename(), sql, limit, tuple(conditions)))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    path = os.path.join(directory, digest)
+    entry = cls.Load(path, key)
+
+    # The stamp must be taken before the high water mark, so that a write made
+    # in between is noticed the next time the entry is used.
+    if stamp is None:
+      stamp = util.Database.GetChangeStamp()
+    if entry and entry['stamp'] == stamp:
+      return entry['rows']
+
+    high_water = util.Database.GetHighWaterMark()
+    if high_water is None:
+      return cls.FetchRange(sql, None, None, limit, conditions)
+    # Sharded ids are not assigned in commit order, so a command committed late
+    # may have an id below the high water mark.
+    appendable = cls.IsAppendable(sql) and not util.Database.GetShardCount()
+    if entry and appendable and entry['high_water'] <= high_water and \
+        entry.get('coverage') and \
+        entry['coverage'] == cls.GetCoverage(entry['high_water']):
+      rows = entry['rows']
+      fetched = rows and len(rows) - 1 or 0
+      if high_water > entry['high_water'] and (not limit or fetched < limit):
+        new_rows = cls.FetchRange(sql, entry['high_water'], high_water,
+                                  limit and limit - fetched, conditions)
+        if new_rows is None:
+          return None
+        if new_rows:
+          rows = rows and rows + new_rows[1:] or new_rows
+    else:
+      rows = cls.FetchRange(sql, None, high_water, limit, conditions)
+      if rows is None:
+        return None
+
+    cls.Store(path, {'key': key, 'stamp': stamp, 'high_water': high_water,
+                     'coverage': appendable and cls.GetCoverage(high_water),
+                     'rows': rows}, directory)
+    return rows
+
+  @classmethod
+  def GetCoverage(cls, high_water):
+    """Returns the count, min and max of the command ids up to high_water.
+
+    This only reads the table's rowids, so it is much cheaper than running a
+    query, and it changes when any of those commands are deleted (for example,
+    to purge a leaked secret from the history).
+    """
+    sql = 'SELECT count(*), min(id), max(id) FROM main.commands WHERE id <= ?'
+    try:
+      row = util.Database.Connect().execute(sql, (high_water,)).fetchone()
+    except sqlite3.Error as e:
+      logging.debug('failed to check the cached commands: %r', e)
+      return None
+    return tuple(row)
+
+  @classmethod
+  def FetchRange(cls, sql, low, high, limit, conditions=()):
+    """Returns the result set of the sql over commands with ids in (low, high].
+
+    Either bound may be None, and only commands matching all the conditions
+    are included.  Returns None if the query failed.
+    """
+    conditions = list(conditions)
+    if low is not None:
+      conditions.append('id > %d' % low)
+    if high is not None:
+      conditions.append('id <= %d' % high)
+    util.Database.ShadowTable('commands', conditions)
+    db = util.Database()
+    try:
+      rows = db.Fetch(sql, limit=limit)
+    finally:
+      util.Database.ShadowTable('commands')
+    if db.error:
+      return None
+    return [tuple(row) for row in rows or []]
+
+  @classmethod
+  def Load(cls, path, key):
+    """Returns the cache entry stored in path, or None."""
+    try:
+      with open(path, 'rb') as fd:
+        entry = pickle.load(fd)
+      # Mark the entry as recently used.
+      os.utime(path, None)
+    except Exception:
+      return None
+    return entry.get('key') == key and entry or None
+
+  @classmethod
+  def Store(cls, path, entry, directory):
+    """Writes the cache entry to path, then evicts old entries if needed."""
+    try:
+      if not os.path.exists(directory):
+        os.makedirs(directory)
+      temp = '%s.%d' % (path, os.getpid())
+      with open(temp, 'wb') as fd:
+        pickle.dump(entry, fd, 2)
+      os.rename(temp, path)
+      cls.Evict(directory)
+    except (IOError, OSError) as e:
+      logging.debug('failed to cache query results: %r', e)
+
+  @classmethod
+  def Evict(cls, directory):
+    """Removes least recently used entries until the cache fits its size."""
+    budget = util.Config().GetInt('QUERY_CACHE_SIZE') * 1024
+    entries = []
+    for name in os.listdir(directory):
+      path = os.path.join(directory, name)
+      st = os.stat(path)
+      entries.append((st.st_mtime, st.st_size, path))
+    used = sum([size for _, size, _ in entries])
+    for _, size, path in sorted(entries):
+      if used <= budget: break
+      os.remove(path)
+      used -= size
+
+
 class Formatter(object):
   """A base class for an object that formats query results into a stream."""
   formatters = []
@@ -146,6 +363,11 @@ class Formatter(object):
         return fmt
     return None
 
+  @classmethod
+  def PrintTitle(cls, title):
+    """Prints a line introducing the next of several result sets."""
+    print('-- %s' % title)
+
   @classmethod
   def GetWidths(cls, rows):
     widths = [0 for _ in rows[0]]
@@ -170,6 +392,8 @@ class AlignedFormatter(Formatter):
     # Print the result set rows aligned.
     widths = Formatter.GetWidths(rows)
     fmt = Formatter.separator.join(['%%%ds' % -width for width in widths])
+    if not Formatter.show_headings:
+      rows = rows[1:]
     for row in rows:
       print(fmt % tuple(row))
 
@@ -295,6 +519,72 @@ class NullFormatter(Formatter):
       print('\0'.join([str(x) for x in row]))
 
 
+def FetchIds(low, high, conditions):
+  """Returns the set of ids of the commands in (low, high] seen by queries."""
+  rows = ResultCache.FetchRange('select id from commands;', low, high, None,
+                                conditions)
+  return set([row[0] for row in (rows or [])[1:]])
+
+
+def Follow(sql, fmt, conditions):
+  """Prints the query results for new commands as they are logged.
+
+  Only the database file stamp is checked while nothing is being logged, so
+  this uses almost no CPU when idle.  When the database changes, the query is
+  run over just the commands logged since the last check.  This continues
+  until interrupted.
+
+  Sharded ids are not assigned in commit order, so a command may be committed
+  with an id below the high water mark.  When sharded, the shards are attached
+  again after every change (in case new ones were created), the ids of the
+  commands within FOLLOW_WINDOW of the high water mark are fetched again, and
+  the query is run over those that were not printed yet.
+  """
+  interval = (util.Config().GetInt('FOLLOW_INTERVAL') or 500) / 1000.0
+  window = util.Database.GetShardCount() and FOLLOW_WINDOW or 0
+  stamp = util.Database.GetChangeStamp()
+  high_water = util.Database.GetHighWaterMark() or 0
+  printed = set()
+  if window:
+    printed = FetchIds(high_water - window, high_water, conditions)
+  rs = ResultCache.FetchRange(sql, None, high_water, None, conditions)
+  if rs:
+    fmt.Print(rs)
+  sys.stdout.flush()
+
+  # Only the first batch of results has headings.
+  Formatter.show_headings = False
+  try:
+    while True:
+      time.sleep(interval)
+      new_stamp = util.Database.GetChangeStamp()
+      if new_stamp == stamp:
+        continue
+      stamp = new_stamp
+      if window:
+        util.Database.Close()
+      new_high_water = util.Database.GetHighWaterMark()
+      if not new_high_water or new_high_water < high_water or \
+          new_high_water == high_water and not window:
+        continue
+      if window:
+        low = new_high_water - window
+        ids = FetchIds(low, new_high_water, conditions) - printed
+        printed = set([x for x in printed if x > low]) | ids
+        rs = ids and ResultCache.FetchRange(
+            sql, None, None, None, list(conditions) + [
+                'id IN (%s)' % ', '.join([str(x) for x in sorted(ids)])])
+      else:
+        rs = ResultCache.FetchRange(sql, high_water, new_high_water, None,
+                                    conditions)
+      high_water = new_high_water
+      if rs:
+        fmt.Print(rs)
+        sys.stdout.flush()
+  except KeyboardInterrupt:
+    return 0
+
+
 def InitFormatters():
   """Create instances of each Formatter available to ash_query.py."""
   AlignedFormatter('aligned', 'Columns are aligned and separated with spaces.')
@@ -309,6 +599,10 @@ def main(argv):
 
   # Print an alert if one was specified.
   flags = Flags()
+  if flags.database:
+    util.Database.filename = flags.database
+  # Queries see the history written to the shards as well, if any.
+  util.Database.read_shards = True
 
   # If no arguments were given, it may be best to show --help.>>
   if len(argv) == 1:
@@ -342,7 +636,17 @@ def main(argv):
     else:
       print('Query: %s\n%s' % (flags.print_query, sql))
 
-  elif flags.query:
+  elif flags.query or flags.script:
+    try:
+      names = Queries.GetNames(flags.query, flags.script)
+    except IOError as e:
+      sys.stderr.write('Failed to read --script: %s\n' % e)
+      return 1
+    for name in names:
+      if name not in Queries.queries:
+        sys.stderr.write('Query not found: %s\n' % name)
+        return 1
+
     # Get the formatter to be used to print the result set.
     default = util.Config().GetString('DEFAULT_FORMAT') or 'aligned'
     format_name = flags.format or default
@@ -351,9 +655,46 @@ def main(argv):
       sys.stderr.write('Unknown format: %s\n' % format_name)
       return 1
 
-    sql = Queries.Get(flags.query)[1]
-    rs = util.Database().Fetch(sql, limit=flags.limit)
-    fmt.Print(rs)
+    # Filter the commands seen by the query in the database engine.
+    conditions = []
+    if flags.grep:
+      try:
+        re.compile(flags.grep)
+      except re.error as e:
+        sys.stderr.write('Invalid --grep pattern: %s (%s)\n' % (flags.grep, e))
+        return 1
+      function = flags.ignore_case and 'iregexp' or 'regexp'
+      pattern = flags.grep.replace("'", "''")
+      conditions.append("%s('%s', command)" % (function, pattern))
+
+    if flags.follow:
+      if len(names) != 1:
+        sys.stderr.write('Only one query can be used with --follow.\n')
+        return 1
+      sql = Queries.Get(names[0])[1]
+      if not ResultCache.IsAppendable(sql):
+        sys.stderr.write('Only queries listing commands in id order can be '
+                         'followed: %s\n' % names[0])
+        return 1
+      return Follow(sql, fmt, conditions)
+
+    # All the queries share one connection, optionally to an in-memory copy.
+    # The copy is only made once a query misses the cache, and the cached
+    # results are stamped with the database as it was before then, since it
+    # may have changed while the copy was made.
+    stamp = None
+    if flags.snapshot:
+      stamp = util.Database.GetChangeStamp()
+      util.Database.snapshot = True
+    for i, name in enumerate(names):
+      if len(names) > 1:
+        if i: print()
+        Formatter.PrintTitle('%s: %s' % (name, Queries.queries[name][0]))
+      sql = Queries.Get(name)[1]
+      rs = ResultCache.Fetch(sql, limit=flags.limit, conditions=conditions,
+                             stamp=stamp)
+      if rs:
+        fmt.Print(rs)
 
   return 0
 